@@ -12,3 +12,7 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from loguru import logger
+
+logger.disable("pve_cslb")
@@ -30,10 +30,6 @@ This module contains the Config class and helpers.
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from loguru import logger
-
-logger.disable("Config")
-
 
 class ConfigurationError(Exception):
     """Custom exception for invalid configuration"""
@@ -45,6 +41,25 @@ class Config:
     and scheduling workload migrations.
     """
 
+    __slots__ = (
+        "_exclude_nodes",
+        "_exclude_types",
+        "_exclude_vmids",
+        "_percent_cpu",
+        "_percent_mem",
+        "args",
+        "config_file",
+        "dry_run",
+        "max_migrations",
+        "no_color",
+        "proxmox_node",
+        "proxmox_pass",
+        "proxmox_port",
+        "proxmox_user",
+        "quiet",
+        "verbose",
+    )
+
     # pylint: disable=R0902
     args: dict
     config_file: str
@@ -52,9 +67,9 @@ class Config:
     verbose: bool
     quiet: bool
     no_color: bool
-    exclude_nodes: list
-    exclude_vmids: list
-    exclude_types: list
+    _exclude_nodes: set
+    _exclude_vmids: set
+    _exclude_types: set
     _percent_cpu: float
     _percent_mem: float
     max_migrations: int
@@ -64,14 +79,15 @@ class Config:
     proxmox_port: int
 
     def __init__(self):
+        self.args = {}
         self.config_file = ""
         self.dry_run = False
         self.verbose = False
         self.quiet = False
         self.no_color = False
-        self.exclude_nodes = []
-        self.exclude_vmids = []
-        self.exclude_types = []
+        self._exclude_nodes = set()
+        self._exclude_vmids = set()
+        self._exclude_types = set()
         self._percent_cpu = 0.4
         self._percent_mem = 0.6
         self.max_migrations = 5
@@ -80,6 +96,36 @@ class Config:
         self.proxmox_node = "localhost"
         self.proxmox_port = 8006
 
+    @property
+    def exclude_nodes(self) -> set:
+        """Property getter for _exclude_nodes"""
+        return self._exclude_nodes
+
+    @exclude_nodes.setter
+    def exclude_nodes(self, exclude_nodes: list | set):
+        """Property setter for _exclude_nodes"""
+        self._exclude_nodes = set(exclude_nodes)
+
+    @property
+    def exclude_vmids(self) -> set:
+        """Property getter for _exclude_vmids"""
+        return self._exclude_vmids
+
+    @exclude_vmids.setter
+    def exclude_vmids(self, exclude_vmids: list | set):
+        """Property setter for _exclude_vmids; VMIDs are stored as strings"""
+        self._exclude_vmids = set(map(str, exclude_vmids))
+
+    @property
+    def exclude_types(self) -> set:
+        """Property getter for _exclude_types"""
+        return self._exclude_types
+
+    @exclude_types.setter
+    def exclude_types(self, exclude_types: list | set):
+        """Property setter for _exclude_types"""
+        self._exclude_types = set(exclude_types)
+
     @property
     def percent_cpu(self) -> float:
         """Property getter for _percent_cpu"""
@@ -87,8 +133,9 @@ class Config:
 
     @percent_cpu.setter
     def percent_cpu(self, percent_cpu: float = 0.4):
-        """Property setter for _percent_cpu"""
+        """Property setter for _percent_cpu; _percent_mem becomes the remainder"""
         self._percent_cpu = percent_cpu
+        self._percent_mem = 1 - float(percent_cpu)
         self.balance_resource_weights()
 
     @property
@@ -98,19 +145,22 @@ class Config:
 
     @percent_mem.setter
     def percent_mem(self, percent_mem: float = 0.6):
-        """Property setter for _percent_mem"""
+        """Property setter for _percent_mem; _percent_cpu becomes the remainder"""
         self._percent_mem = percent_mem
+        self._percent_cpu = 1 - float(percent_mem)
         self.balance_resource_weights()
 
-    def __dict__(self) -> dict:
+    def to_dict(self) -> dict:
+        """Returns the configuration as a plain dict"""
         return {
             "config_file": self.config_file,
             "dry_run": self.dry_run,
             "verbose": self.verbose,
             "quiet": self.quiet,
-            "exclude_nodes": self.exclude_nodes,
-            "exclude_vmids": self.exclude_vmids,
-            "exclude_types": self.exclude_types,
+            "no_color": self.no_color,
+            "exclude_nodes": list(self.exclude_nodes),
+            "exclude_vmids": list(self.exclude_vmids),
+            "exclude_types": list(self.exclude_types),
             "percent_cpu": self.percent_cpu,
             "percent_mem": self.percent_mem,
             "max_migrations": self.max_migrations,
@@ -122,21 +172,29 @@ class Config:
 
     def balance_resource_weights(self):
         """Ensures resource weighting proportions always sum to 1"""
-        if self._percent_cpu + self._percent_mem > 1:
-            if self._percent_cpu > self._percent_mem:
-                self._percent_cpu = min(self._percent_cpu, 1)
-                self._percent_mem = 1 - self._percent_cpu
-            if self._percent_cpu < self._percent_mem:
-                self._percent_mem = min(self._percent_mem, 1)
-                self._percent_cpu = 1 - self._percent_mem
-            if self._percent_cpu == self._percent_mem:
-                self._percent_cpu = 0.5
-                self._percent_mem = 0.5
-        if self._percent_cpu + self._percent_mem < 1:
-            if self._percent_cpu > self._percent_mem:
-                self._percent_cpu = 1 - self._percent_mem
-            if self._percent_mem > self._percent_cpu:
-                self._percent_mem = 1 - self._percent_cpu
-            if self._percent_cpu == self._percent_mem:
-                self._percent_cpu = 0.5
-                self._percent_mem = 0.5
+        percent_cpu = min(max(float(self._percent_cpu), 0.0), 1.0)
+        percent_mem = min(max(float(self._percent_mem), 0.0), 1.0)
+        total = percent_cpu + percent_mem
+        if total == 0:
+            self._percent_cpu = self._percent_mem = 0.5
+            return
+        self._percent_cpu = percent_cpu / total
+        self._percent_mem = 1.0 - self._percent_cpu
+
+
+_instance: Config | None = None
+
+
+def get_config() -> Config:
+    """Returns the shared Config instance, creating it on first use"""
+    global _instance
+    if _instance is None:
+        _instance = Config()
+    return _instance
+
+
+def reset_config() -> Config:
+    """Replaces the shared Config instance with a fresh one and returns it"""
+    global _instance
+    _instance = Config()
+    return _instance
@@ -33,6 +33,8 @@
 class MigrationSpec:
     """Model for workload migration candidates"""
 
+    __slots__ = ("destination", "kind", "name", "source", "vmid")
+
     source: str
     destination: str
     name: str
@@ -0,0 +1,58 @@
+"""Model for node load state"""
+
+#  Copyright (C) 2024 Travis Wichert
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# pylint: disable=R0903
+class NodeState:
+    """Model for node load state"""
+
+    __slots__ = (
+        "cpu_free",
+        "heaviest",
+        "mem_free",
+        "weight",
+        "workload_count",
+        "workloads",
+    )
+
+    weight: int
+    mem_free: int
+    cpu_free: float
+    workload_count: int
+    workloads: dict
+    heaviest: tuple | None
+
+    def __init__(self, weight: int, mem_free: int, cpu_free: float, workloads: dict):
+        self.weight = weight
+        self.mem_free = mem_free
+        self.cpu_free = cpu_free
+        self.workload_count = len(workloads)
+        self.workloads = workloads
+        self.heaviest = None
@@ -31,16 +31,13 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from argparse import ArgumentParser
+from functools import cache
 from os import environ
-from re import compile
-from re import match as re_match
 from sys import exit, stdout
 
 from loguru import logger
-from yaml import safe_load
 
-from pve_cslb.config import Config, ConfigurationError
-from pve_cslb.workload_balancer import WorkloadBalancer
+from pve_cslb.config import Config, ConfigurationError, reset_config
 
 __version__ = "1.4.0"
 __title__ = "pve-cslb"
@@ -51,13 +48,92 @@ __description__ = """
 A workload balancing engine for ProxmoxPVE.  Identifies nodes with imbalanced loads and migrates workloads around to even things out.
 """
 
-re_pluralize = compile(r"^(include|exclude)_(node|type|vmid)$")
-re_include = compile(r"^include_.*$")
-re_exclude = compile(r"^exclude.*$")
+cli_only_vars = ("verbose", "quiet", "no_color")
 
+yaml_vars = frozenset(
+    {
+        "dry_run",
+        "verbose",
+        "quiet",
+        "no_color",
+        "exclude_nodes",
+        "exclude_vmids",
+        "exclude_types",
+        "percent_cpu",
+        "percent_mem",
+        "max_migrations",
+        "proxmox_user",
+        "proxmox_pass",
+        "proxmox_node",
+        "proxmox_port",
+    }
+)
 
-@logger.catch(level="ERROR")
-def main():
+
+def load_yaml(data: bytes) -> dict:
+    """Parses YAML, with libyaml when available; imported here to keep --help fast"""
+    # pylint: disable=C0415
+    from yaml import load
+
+    try:
+        from yaml import CSafeLoader as YamlLoader
+    except ImportError:
+        from yaml import SafeLoader as YamlLoader
+
+    return load(data, Loader=YamlLoader)
+
+
+def parse_bool(value: str) -> bool:
+    """Interprets common truthy strings from the environment as True"""
+    return value.strip().lower() in {"1", "true", "yes", "on"}
+
+
+scalar_vars = tuple(
+    (var, f"CSLB_{var.upper()}", coerce)
+    for var, coerce in (
+        ("proxmox_node", str),
+        ("proxmox_port", int),
+        ("proxmox_user", str),
+        ("proxmox_pass", str),
+        ("percent_cpu", float),
+        ("percent_mem", float),
+        ("max_migrations", int),
+        ("dry_run", parse_bool),
+    )
+)
+
+
+def add_excludes(lb_config: Config, attr: str, items: list) -> set:
+    """Adds items to a Config exclude set, returns the items that were added"""
+    current = getattr(lb_config, attr)
+    added = set(items) - current
+    current.update(added)
+    return added
+
+
+def remove_excludes(lb_config: Config, attr: str, items: list) -> set:
+    """Removes items from a Config exclude set, returns the items that were removed"""
+    current = getattr(lb_config, attr)
+    removed = current.intersection(items)
+    current.difference_update(removed)
+    return removed
+
+
+list_handlers = {
+    var: (f"CSLB_{var.upper()}S", handler, attr, action)
+    for var, handler, attr, action in (
+        ("exclude_node", add_excludes, "exclude_nodes", "added"),
+        ("exclude_vmid", add_excludes, "exclude_vmids", "added"),
+        ("exclude_type", add_excludes, "exclude_types", "added"),
+        ("include_node", remove_excludes, "exclude_nodes", "removed"),
+        ("include_vmid", remove_excludes, "exclude_vmids", "removed"),
+        ("include_type", remove_excludes, "exclude_types", "removed"),
+    )
+}
+
+
+@cache
+def build_parser() -> ArgumentParser:
     parser = ArgumentParser(
         prog="pve-cslb",
         description=f"{__title__} {__version__} - {__description__}",
@@ -73,22 +149,26 @@ def main():
         "-v",
         "--verbose",
         action="store_true",
+        default=None,
         help="Increase verbosity (default: false)",
     )
     parser.add_argument(
         "-q",
         "--quiet",
         action="store_true",
+        default=None,
         help="Only output errors (default: false)",
     )
     parser.add_argument(
         "--no-color",
         action="store_true",
+        default=None,
         help="Disable ANSI color in output (default: false)",
     )
     parser.add_argument(
         "--dry-run",
         action="store_true",
+        default=None,
         help="Perform read-only analysis; no write actions. (default: false)",
     )
     parser.add_argument(
@@ -163,7 +243,12 @@ def main():
         action="append",
         help="Include a previously excluded workload type (must be 'lxc' or 'qemu'; can be specified multiple times)",
     )
-    args = vars(parser.parse_args())
+    return parser
+
+
+@logger.catch(level="ERROR")
+def main():
+    args = vars(build_parser().parse_args())
 
     log_level = "INFO"
     if args["verbose"]:
@@ -183,124 +268,90 @@ def main():
         ],
     }
     logger.configure(**logging_config)
-    logger.enable("WorkloadBalancer")
-    logger.enable("Config")
+    logger.enable("pve_cslb")
 
     if not args:
         raise ConfigurationError("Cannot continue, not fully configured.")
 
-    lb_config = Config()
-    setattr(lb_config, "config_file", args["config_file"])
+    # Resolve from defaults on every call; don't inherit a previous run's options
+    lb_config = reset_config()
+    config_file = args.get("config_file")
+    lb_config.config_file = config_file
 
     # First read from config file
-    if "config_file" in args.keys() and args["config_file"]:
-        logger.debug(f"CLI: Configured config_file = {args['config_file']}")
+    if config_file:
+        logger.debug("CLI: Configured config_file = {}", config_file)
         try:
-            with open(args["config_file"], "r") as stream:
-                config = safe_load(stream)
-                for k, v in config.items():
-                    setattr(lb_config, k, v)
-                    logger.debug(
-                        f"YML: Configured {k} = {'*****' if k == 'proxmox_pass' else v}"
-                    )
+            with open(config_file, "rb") as stream:
+                data = stream.read()
         except FileNotFoundError:
             raise ConfigurationError("Config file not found")
 
+        config = load_yaml(data)
+        for k, v in config.items():
+            if k not in yaml_vars:
+                logger.warning("YML: Ignoring unknown configuration option: {}", k)
+                continue
+            setattr(lb_config, k, v)
+            logger.debug(
+                "YML: Configured {} = {}",
+                k,
+                "*****" if k == "proxmox_pass" else v,
+            )
+
     # Next configure from CLI and ENV
+    overrides = {k: v for k, v in args.items() if v is not None and k != "config_file"}
+
     # CLI-only vars
-    for var in [
-        "verbose",
-        "quiet",
-        "no_color",
-    ]:
-        if var in args.keys():
-            if args[var] is not None:
-                setattr(lb_config, var, args[var])
-                logger.debug(f"CLI: Configured {var} = {args[var]}")
+    for var in cli_only_vars:
+        cli_value = overrides.get(var)
+        if cli_value is not None:
+            setattr(lb_config, var, cli_value)
+            logger.debug("CLI: Configured {} = {}", var, cli_value)
 
     # Scalars
-    for var in [
-        "proxmox_node",
-        "proxmox_port",
-        "proxmox_user",
-        "proxmox_pass",
-        "percent_cpu",
-        "percent_mem",
-        "max_migrations",
-        "dry_run",
-    ]:
-        if environ.get(f"CSLB_{var.upper()}"):
-            setattr(lb_config, var, environ.get(f"CSLB_{var.upper()}"))
+    for var, env_key, coerce in scalar_vars:
+        env_value = environ.get(env_key)
+        if env_value:
+            try:
+                env_value = coerce(env_value)
+            except ValueError:
+                raise ConfigurationError(f"Invalid value for {env_key}: {env_value}")
+            setattr(lb_config, var, env_value)
             logger.debug(
-                f"ENV: Configured {var} = {'*****' if var == 'proxmox_pass' else environ.get(f'CSLB_{var.upper()}')} (from CSLB_{var.upper()})"
+                "ENV: Configured {} = {} (from {})",
+                var,
+                "*****" if var == "proxmox_pass" else env_value,
+                env_key,
             )
 
-        if var in args.keys():
-            if args[var] is not None:
-                setattr(lb_config, var, args[var])
-                logger.debug(
-                    f"CLI: Configured {var + 's' if re_match(re_pluralize, var) else var} = {'*****' if var == 'proxmox_pass' else args[var]}"
-                )
+        cli_value = overrides.get(var)
+        if cli_value is not None:
+            setattr(lb_config, var, cli_value)
+            logger.debug(
+                "CLI: Configured {} = {}",
+                var,
+                "*****" if var == "proxmox_pass" else cli_value,
+            )
 
     # Lists
-    for var in [
-        "exclude_node",
-        "exclude_vmid",
-        "exclude_type",
-        "include_node",
-        "include_vmid",
-        "include_type",
-    ]:
-        var_s = var + "s"
-        ex_var_s = var_s.replace("include", "exclude")
-
-        if environ.get(f"CSLB_{var_s.upper()}"):
-            if re_match(re_exclude, var):
-                env_list = environ.get(f"CSLB_{var_s.upper()}").split(" ")
-                cnf_list = getattr(lb_config, var_s)
-                new_list = cnf_list + env_list
-                setattr(lb_config, var_s, new_list)
-                logger.debug(
-                    f"ENV: Configured {var_s}: added {env_list} (from CSLB_{var_s.upper()})"
-                )
-                del env_list
-                del cnf_list
-                del new_list
-
-            if re_match(re_include, var):
-                env_list = environ.get(f"CSLB_{var_s.upper()}").split(" ")
-                cnf_list = getattr(lb_config, ex_var_s)
-                new_list = []
-                for item in cnf_list:
-                    if item in env_list:
-                        continue
-                    new_list.append(item)
-                setattr(lb_config, ex_var_s, new_list)
-                logger.debug(
-                    f"ENV: Configured {ex_var_s}: removed {env_list} (from CSLB_{var_s.upper()})"
-                )
-                del env_list
-                del cnf_list
-                del new_list
-
-        if var in args.keys() and args[var] is not None:
-            if re_match(re_exclude, var):
-                cnf_list = getattr(lb_config, var_s)
-                for item in args[var]:
-                    if item not in cnf_list:
-                        new_list = cnf_list + [item]
-                        setattr(lb_config, var_s, new_list)
-                        logger.debug(f"CLI: Configured {var_s}: added {item}")
-                del cnf_list
-
-            if re_match(re_include, var):
-                cnf_list = getattr(lb_config, ex_var_s)
-                for item in args[var]:
-                    if item in cnf_list:
-                        cnf_list.remove(item)
-                        setattr(lb_config, ex_var_s, cnf_list)
-                        logger.debug(f"CLI: Configured {ex_var_s}: removed {item}")
-                del cnf_list
+    for var, (env_key, handler, attr, action) in list_handlers.items():
+        env_value = environ.get(env_key)
+        if env_value:
+            changed = handler(lb_config, attr, env_value.split())
+            logger.debug(
+                "ENV: Configured {}: {} {} (from {})", attr, action, changed, env_key
+            )
+
+        cli_value = overrides.get(var)
+        if cli_value is not None:
+            changed = handler(lb_config, attr, cli_value)
+            if changed:
+                logger.debug("CLI: Configured {}: {} {}", attr, action, changed)
+
+    # Deferred so --help and configuration errors don't pay for proxmoxer/requests
+    # pylint: disable=C0415
+    from pve_cslb.workload_balancer import WorkloadBalancer
 
     my_cslb = WorkloadBalancer(lb_config)
     migration_candidates = my_cslb.get_migration_candidates()
@@ -310,10 +361,10 @@ def main():
         exit(0)
 
     if not lb_config.dry_run:
-        migrations = list()
-        for migration_candidate in migration_candidates:
-            success, jobspec = my_cslb.do_migration(migration_candidate)
-            migrations.append(jobspec)
+        migrations = my_cslb.do_migrations(migration_candidates)
+        failed = sum(1 for success, _ in migrations if not success)
+        if failed:
+            logger.warning("{} of {} migration(s) failed", failed, len(migrations))
         logger.success("Migration job(s) submitted")
 
         exit(0)
@@ -26,36 +26,121 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from statistics import mean
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import cached_property
+from heapq import heapify, heappop, heappush
 
 from loguru import logger
 from proxmoxer import AuthenticationError, ProxmoxAPI, ResourceException
+from proxmoxer.backends.https import JsonSerializer
 from proxmoxer.tools import Tasks
+from requests.adapters import HTTPAdapter, Retry
 from requests.exceptions import ConnectionError
 
 from .config import Config
 from .migration_spec import MigrationSpec
+from .node_state import NodeState
+from .workload_state import WorkloadState
 
-logger.disable("WorkloadBalancer")
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = None
 
 SIZE_MEBIBYTE = 1048576
 
+# Upper bound on concurrent API fetches, and on pooled keep-alive connections
+MAX_FETCH_WORKERS = 32
+
+# Resource fields kept from each cluster/resources entry for scoring
+WORKLOAD_FIELDS = ("name", "type", "maxcpu", "cpu", "maxmem", "mem")
+
+# Workload types the balancer can migrate, with their display names
+WORKLOAD_KINDS = {"qemu": "QEMU", "lxc": "LXC"}
+
 
 def mib_round(x: int | float):
     return round(x / SIZE_MEBIBYTE, 2)
 
 
+# pylint: disable=R0913
+def score_node(
+    cpu_mhz: float,
+    cpu_cores: float,
+    loadavg: list,
+    mem_total: int,
+    mem_used: int,
+    mem_ksm: int,
+    k_cpu: float,
+    k_mem: float,
+) -> tuple:
+    cpu_load = sum(map(float, loadavg)) / len(loadavg)
+    cpu_total = cpu_mhz * cpu_cores
+    cpu_free = cpu_total - cpu_mhz * cpu_load
+    w_cpu = k_cpu * (cpu_total / cpu_free)
+
+    mem_free_no_ksm = mem_total - (mem_used + mem_ksm)
+    w_mem = k_mem * (mem_total / mem_free_no_ksm)
+
+    return (
+        round(w_cpu + w_mem),
+        cpu_load,
+        cpu_total,
+        cpu_free,
+        w_cpu,
+        mem_free_no_ksm,
+        w_mem,
+    )
+
+
+# pylint: disable=R0913
+def score_workload(
+    cpu_cores: float,
+    cpu_load: float,
+    cpu_mhz: float,
+    mem_max: float,
+    mem_used: float,
+    k_cpu: float,
+    k_mem: float,
+) -> tuple:
+    cpu_used = cpu_mhz * cpu_load
+    cpu_max = cpu_mhz * cpu_cores
+
+    # This prevents division by zero
+    if cpu_used <= 0.001:
+        cpu_used = 0.001
+    w_cpu = k_cpu * (cpu_used / cpu_max)
+    w_mem = k_mem * (mem_used / mem_max)
+
+    return round(w_cpu + w_mem), cpu_used
+
+
+class OrjsonSerializer(JsonSerializer):
+    def loads(self, response):
+        try:
+            return json_loads(response.content)["data"]
+        except ValueError:
+            return {"errors": response.content}
+
+
 class WorkloadBalancer:
     conf = None
     proxmox = None
 
     def __init__(self, conf: Config) -> None:
         self.conf = conf
+        # Resource weights as percentages, for the scoring functions
+        self._k_cpu = conf.percent_cpu * 100
+        self._k_mem = conf.percent_mem * 100
+
+    @cached_property
+    def pve(self) -> ProxmoxAPI:
         logger.info(
-            f"Using Proxmox API at {self.conf.proxmox_node}:{self.conf.proxmox_port}"
+            "Using Proxmox API at {}:{}", self.conf.proxmox_node, self.conf.proxmox_port
         )
         try:
-            self.pve = ProxmoxAPI(
+            pve = ProxmoxAPI(
                 host=self.conf.proxmox_node,
                 port=self.conf.proxmox_port,
                 user=self.conf.proxmox_user,
@@ -64,233 +149,305 @@ class WorkloadBalancer:
         except (ResourceException, ConnectionError, AuthenticationError) as e:
             logger.error(e)
             exit(1)
+        pve._store["session"].mount(
+            "https://",
+            HTTPAdapter(
+                pool_maxsize=MAX_FETCH_WORKERS,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.2,
+                    status_forcelist=(502, 503, 504),
+                    raise_on_status=False,
+                ),
+            ),
+        )
+        if json_loads is not None:
+            pve._store["serializer"] = OrjsonSerializer()
+        return pve
 
     def get_node_state(self, node_name: str, node_status: dict) -> (int, int, float):
         cpu_mhz = float(node_status["cpuinfo"]["mhz"])
         cpu_cores = float(node_status["cpuinfo"]["cores"])
-        cpu_load = mean(list(map(float, node_status["loadavg"])))
-        cpu_total = cpu_mhz * cpu_cores
-        cpu_used = cpu_mhz * cpu_load
-        cpu_free = cpu_total - cpu_used
-        logger.debug(
-            f"Node {node_name}: cpu_mhz: {cpu_mhz}, cores: {cpu_cores}, load: {round(cpu_load, 2)}"
-        )
-
-        w_cpu = self.conf.percent_cpu * (cpu_total / cpu_free) * 100
-        logger.debug(
-            f"Node {node_name}: cpu_total: {round(cpu_total, 2)}, cpu_free: {round(cpu_free, 2)}, w_cpu {round(w_cpu, 2)}"
-        )
-
         mem_total = int(node_status["memory"]["total"])
         mem_used = int(node_status["memory"]["used"])
         mem_free = int(node_status["memory"]["free"])
         mem_ksm = int(node_status["ksm"]["shared"])
-        mem_free_no_ksm = mem_total - (mem_used + mem_ksm)
-        logger.debug(
-            f"Node {node_name}: mem_free: {mib_round(mem_free)} MiB, mem_ksm: {mib_round(mem_ksm)} MiB, mem_total: {mib_round(mem_total)} MiB"
+
+        weight, cpu_load, cpu_total, cpu_free, w_cpu, mem_free_no_ksm, w_mem = (
+            score_node(
+                cpu_mhz,
+                cpu_cores,
+                node_status["loadavg"],
+                mem_total,
+                mem_used,
+                mem_ksm,
+                self._k_cpu,
+                self._k_mem,
+            )
         )
 
-        w_mem = self.conf.percent_mem * (mem_total / mem_free_no_ksm) * 100
         logger.debug(
-            f"Node {node_name}: mem_total: {mib_round(mem_total)} MiB, mem_free_no_ksm: {mib_round(mem_free_no_ksm)} MiB, w_mem {round(w_mem, 2)}"
+            "Node {}: cpu_mhz: {}, cores: {}, load: {}",
+            node_name,
+            cpu_mhz,
+            cpu_cores,
+            round(cpu_load, 2),
+        )
+        logger.debug(
+            "Node {}: cpu_total: {}, cpu_free: {}, w_cpu {}",
+            node_name,
+            round(cpu_total, 2),
+            round(cpu_free, 2),
+            round(w_cpu, 2),
+        )
+        mem_total_mib = mib_round(mem_total)
+        logger.debug(
+            "Node {}: mem_free: {} MiB, mem_ksm: {} MiB, mem_total: {} MiB",
+            node_name,
+            mib_round(mem_free),
+            mib_round(mem_ksm),
+            mem_total_mib,
+        )
+        logger.debug(
+            "Node {}: mem_total: {} MiB, mem_free_no_ksm: {} MiB, w_mem {}",
+            node_name,
+            mem_total_mib,
+            mib_round(mem_free_no_ksm),
+            round(w_mem, 2),
         )
-        weight = round(w_cpu + w_mem)
 
-        logger.info(f"Node {node_name}: weight: {weight}")
+        logger.info("Node {}: weight: {}", node_name, weight)
         return weight, mem_free, cpu_free
 
-    def get_node_workloads(self, node: dict) -> dict:
-        workloads = {}
-
-        if "qemu" not in self.conf.exclude_types:
-            try:
-                workloads_from_node = self.pve.nodes(node["node"]).qemu.get()
-            except (ResourceException, ConnectionError) as e:
-                logger.error(e)
-                exit(1)
-
-            for workload in workloads_from_node:
-                vmid = str(workload["vmid"])
-                if vmid in self.conf.exclude_vmids:
-                    logger.debug(f"Ignoring VMID {vmid} per configuration")
-                    continue
-                if workload["status"] != "running":
-                    continue
-                workload.update({"kind": "qemu"})
-                del workload["vmid"]
-                workloads.update({vmid: workload})
-            del workloads_from_node
-        else:
-            logger.debug("Ignoring QEMU workloads per configuration")
-
-        if "lxc" not in self.conf.exclude_types:
-            try:
-                workloads_from_node = self.pve.nodes(node["node"]).lxc.get()
-            except (ResourceException, ConnectionError) as e:
-                logger.error(e)
-                exit(1)
-
-            for workload in workloads_from_node:
-                vmid = str(workload["vmid"])
-                if vmid in self.conf.exclude_vmids:
-                    logger.debug(f"Ignoring VMID {vmid} per configuration")
-                    continue
-                if workload["status"] != "running":
-                    continue
-                workload.update({"kind": "lxc"})
-                del workload["vmid"]
-                workloads.update({vmid: workload})
-            del workloads_from_node
-        else:
-            logger.debug("Ignoring LXC workloads per configuration")
+    def get_cluster_workloads(self) -> dict:
+        workloads = defaultdict(dict)
+        exclude_vmids = self.conf.exclude_vmids
+        exclude_nodes = self.conf.exclude_nodes
 
-        return workloads
+        kinds = set()
+        for kind, label in WORKLOAD_KINDS.items():
+            if kind in self.conf.exclude_types:
+                logger.debug("Ignoring {} workloads per configuration", label)
+                continue
+            kinds.add(kind)
 
-    def get_workload_state(
-        self, node_name: str, node_status: dict, vmid: int, workload: dict
-    ) -> (int, int, float):
-        workload_name = workload["name"]
-        workload_kind = workload["kind"]
+        try:
+            workloads_from_cluster = self.pve.cluster.resources.get(type="vm")
+        except (ResourceException, ConnectionError) as e:
+            logger.error(e)
+            exit(1)
 
-        cpu_cores = float(workload["cpus"])
-        cpu_load = float(workload["cpu"])
-        cpu_mhz = float(node_status["cpuinfo"]["mhz"])
-        cpu_used = cpu_mhz * cpu_load
-        cpu_max = cpu_mhz * cpu_cores
+        running = {
+            str(workload["vmid"]): workload
+            for workload in workloads_from_cluster
+            if workload["status"] == "running"
+            and workload["type"] in kinds
+            and workload["node"] not in exclude_nodes
+        }
+        for vmid in running.keys() & exclude_vmids:
+            logger.debug("Ignoring VMID {} per configuration", vmid)
+            del running[vmid]
+
+        for vmid, workload in running.items():
+            workloads[workload["node"]][vmid] = {
+                field: workload[field] for field in WORKLOAD_FIELDS
+            }
 
-        # This prevents division by zero
-        if cpu_used <= 0.001:
-            cpu_used = 0.001
-        w_cpu = self.conf.percent_cpu * (cpu_used / cpu_max) * 100
+        return workloads
 
-        mem_max = float(workload["maxmem"])
+    def get_workload_state(
+        self, node_name: str, cpu_mhz: float, vmid: int, workload: dict
+    ) -> (int, int, float):
         mem_used = float(workload["mem"])
-        w_mem = self.conf.percent_mem * (mem_used / mem_max) * 100
-
-        weight = round(w_cpu + w_mem)
+        weight, cpu_used = score_workload(
+            float(workload["maxcpu"]),
+            float(workload["cpu"]),
+            cpu_mhz,
+            float(workload["maxmem"]),
+            mem_used,
+            self._k_cpu,
+            self._k_mem,
+        )
 
         logger.debug(
-            f"Node {node_name}: workload {workload_kind}/{vmid} '{workload_name}': weight: {weight}, mem_used: {mib_round(mem_used)} MiB, cpu_used: {round(cpu_used, 2)}"
+            "Node {}: workload {}/{} '{}': weight: {}, mem_used: {} MiB, cpu_used: {}",
+            node_name,
+            workload["type"],
+            vmid,
+            workload["name"],
+            weight,
+            mib_round(mem_used),
+            round(cpu_used, 2),
         )
 
         return weight, mem_used, cpu_used
 
+    def fetch_node(self, node: dict) -> (str, dict):
+        node_name = node["node"]
+        try:
+            node_status = self.pve.nodes(node_name).status.get()
+        except (ResourceException, ConnectionError) as e:
+            logger.error(e)
+            exit(1)
+        return node_name, node_status
+
     def get_migration_candidates(self) -> list:
         node_states = {}
+        sum_w = 0
+        sum_l = 0
 
-        for node in self.pve.nodes.get():
-            node_name = node["node"]
-            if node_name in self.conf.exclude_nodes:
-                logger.debug(f"Node {node['node']}: ignoring per configuration")
-                continue
-
-            node_status = self.pve.nodes(node_name).status.get()
-            weight, mem_free, cpu_free = self.get_node_state(node_name, node_status)
-
-            node_states[node_name] = {
-                "weight": weight,
-                "mem_free": mem_free,
-                "cpu_free": cpu_free,
-            }
+        exclude_nodes = self.conf.exclude_nodes
+        try:
+            nodes_from_cluster = self.pve.cluster.resources.get(type="node")
+        except (ResourceException, ConnectionError) as e:
+            logger.error(e)
+            exit(1)
 
-            workloads = self.get_node_workloads(node)
-            for vmid, workload in workloads.items():
-                weight, mem_used, cpu_max = self.get_workload_state(
-                    node_name, node_status, vmid, workload
-                )
-                workloads[vmid].update(
-                    {
-                        "weight": weight,
-                        "mem_used": mem_used,
-                        "cpu_max": cpu_max,
-                    }
+        nodes = []
+        for node in nodes_from_cluster:
+            if node["node"] in exclude_nodes:
+                logger.debug("Node {}: ignoring per configuration", node["node"])
+                continue
+            if node["status"] != "online":
+                logger.warning(
+                    "Node {}: ignoring, node is {}", node["node"], node["status"]
                 )
+                continue
+            nodes.append(node)
+
+        # Nothing can move without at least one other node to receive it
+        if len(nodes) < 2:
+            logger.warning("Fewer than two nodes available for balancing")
+            return []
+
+        cluster_workloads = self.get_cluster_workloads()
+
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(MAX_FETCH_WORKERS, len(nodes)))
+        ) as executor:
+            futures = [executor.submit(self.fetch_node, node) for node in nodes]
+
+            # Score each node as soon as its status arrives
+            for future in as_completed(futures):
+                node_name, node_status = future.result()
+                weight, mem_free, cpu_free = self.get_node_state(node_name, node_status)
+                workloads = cluster_workloads.get(node_name, {})
+                cpu_mhz = float(node_status["cpuinfo"]["mhz"])
+
+                for vmid, workload in workloads.items():
+                    w_weight, mem_used, cpu_max = self.get_workload_state(
+                        node_name, cpu_mhz, vmid, workload
+                    )
+                    workloads[vmid] = WorkloadState(
+                        workload["name"], workload["type"], w_weight, mem_used, cpu_max
+                    )
 
-            node_states[node_name].update(
-                {
-                    "workload_count": len(workloads),
-                    "workloads": workloads,
-                }
-            )
+                node_states[node_name] = NodeState(
+                    weight, mem_free, cpu_free, workloads
+                )
+                sum_w += weight
+                sum_l += len(workloads)
 
-        w_mean = mean([n["weight"] for n in node_states.values()])
-        l_mean = mean([n["workload_count"] for n in node_states.values()])
+        w_mean = sum_w / len(node_states)
+        l_mean = sum_l / len(node_states)
 
         logger.debug(
-            f"Stats: Mean Weight: {round(w_mean, 2)}, Mean Workload Count: {round(l_mean, 2)}"
+            "Stats: Mean Weight: {}, Mean Workload Count: {}",
+            round(w_mean, 2),
+            round(l_mean, 2),
         )
 
-        candidates = {"source": {}, "destination": {}}
-        source_count = 0
-        destination_count = 0
+        # Heaviest source first, lightest destination first; the index keeps ties in
+        # node order
+        source_heap = []
+        destination_heap = []
 
-        for node, state in node_states.items():
-            if state["weight"] < w_mean:
-                candidates["destination"].update({node: state})
-                destination_count += 1
+        for i, node in enumerate(node["node"] for node in nodes):
+            state = node_states[node]
+            if state.weight < w_mean:
+                destination_heap.append((state.weight, i, node))
                 logger.debug(
-                    f"Found destination candidate: {node} (weight: {state['weight']}, workload_count: {state['workload_count']})"
+                    "Found destination candidate: {} (weight: {}, workload_count: {})",
+                    node,
+                    state.weight,
+                    state.workload_count,
                 )
-            if state["weight"] > w_mean and state["workload_count"] > l_mean:
-                candidates["source"].update({node: state})
-                source_count += 1
+            if state.weight > w_mean and state.workload_count > l_mean:
+                state.heaviest = max(state.workloads.items(), key=lambda x: x[1].weight)
+                source_heap.append((-state.weight, i, node))
                 logger.debug(
-                    f"Found source candidate: {node} (weight: {state['weight']}, workload_count: {state['workload_count']})"
+                    "Found source candidate: {} (weight: {}, workload_count: {})",
+                    node,
+                    state.weight,
+                    state.workload_count,
                 )
 
+        heapify(source_heap)
+        heapify(destination_heap)
+
         migration_proposals = []
 
         while (
-            source_count > 0
-            and destination_count > 0
+            source_heap
+            and destination_heap
             and len(migration_proposals) <= self.conf.max_migrations
         ):
-            source_name, source_workloads = sorted(
-                candidates["source"].items(), key=lambda x: x[1]["weight"], reverse=True
-            )[0]
-            vmid, workload = sorted(
-                candidates["source"][source_name]["workloads"].items(),
-                key=lambda x: x[1]["weight"],
-                reverse=True,
-            )[0]
-            del candidates["source"][source_name]
-            source_count -= 1
+            _, _, source_name = heappop(source_heap)
+            vmid, workload = node_states[source_name].heaviest
+            mem_used = workload.mem_used
+            cpu_max = workload.cpu_max
 
             # Find a destination candidate with enough free memory for the source workload
-            for destination_name, _ in sorted(
-                candidates["destination"].items(),
-                key=lambda x: x[1]["weight"],
-                reverse=False,
-            ):
+            skipped = []
+            while destination_heap:
+                destination = heappop(destination_heap)
+                destination_name = destination[2]
+                destination_state = node_states[destination_name]
                 if (
-                    node_states[destination_name]["mem_free"] > workload["mem_used"]
-                    and node_states[destination_name]["cpu_free"] > workload["cpu_max"]
+                    destination_state.mem_free > mem_used
+                    and destination_state.cpu_free > cpu_max
                 ):
-                    del candidates["destination"][destination_name]
-                    destination_count -= 1
                     logger.debug(
-                        f"Proposing workload migration: '{workload['name']}' ({workload['kind']}/{vmid}) from node {source_name} to node {destination_name}"
+                        "Proposing workload migration: '{}' ({}/{}) from node {} to node {}",
+                        workload.name,
+                        workload.kind,
+                        vmid,
+                        source_name,
+                        destination_name,
                     )
                     migration_proposals.append(
                         MigrationSpec(
                             source_name,
                             destination_name,
-                            workload["name"],
+                            workload.name,
                             vmid,
-                            workload["kind"],
+                            workload.kind,
                         )
                     )
                     break
-                else:
-                    logger.warning(
-                        f"Could not find a destination node with enough free resources for workload '{workload['name']}' ({workload['kind']}/{vmid}) on node {source_name}"
-                    )
+                skipped.append(destination)
+            else:
+                logger.warning(
+                    "Could not find a destination node with enough free resources for workload '{}' ({}/{}) on node {}",
+                    workload.name,
+                    workload.kind,
+                    vmid,
+                    source_name,
+                )
+
+            for destination in skipped:
+                heappush(destination_heap, destination)
 
         return migration_proposals
 
     def do_migration(self, spec: MigrationSpec) -> (bool, str):
         logger.success(
-            f"Migrating workload '{spec.name}' ({spec.kind}/{spec.vmid}) from node {spec.source} to node {spec.destination}"
+            "Migrating workload '{}' ({}/{}) from node {} to node {}",
+            spec.name,
+            spec.kind,
+            spec.vmid,
+            spec.source,
+            spec.destination,
         )
 
         try:
@@ -311,12 +468,17 @@ class WorkloadBalancer:
                     raise TypeError(f"Unknown workload type: {spec.kind}")
 
         except ResourceException as e:
-            logger.error(f"Migration failed, {spec.kind} is locked: {e}")
+            logger.error("Migration failed, {} is locked: {}", spec.kind, e)
             return False, None
 
         except ConnectionError as e:
-            logger.error(f"Migration failed, connection error: {e}")
+            logger.error("Migration failed, connection error: {}", e)
             return False, None
 
-        logger.debug(f"Migration UPID: {job['upid']}")
+        logger.debug("Migration UPID: {}", job["upid"])
         return True, job
+
+    def do_migrations(self, specs: list) -> list:
+        workers = max(1, min(self.conf.max_migrations, len(specs)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.do_migration, specs))
@@ -0,0 +1,52 @@
+"""Model for workload load state"""
+
+#  Copyright (C) 2024 Travis Wichert
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# pylint: disable=R0903
+class WorkloadState:
+    """Model for workload load state"""
+
+    __slots__ = ("cpu_max", "kind", "mem_used", "name", "weight")
+
+    name: str
+    kind: str
+    weight: int
+    mem_used: float
+    cpu_max: float
+
+    # pylint: disable=R0913
+    def __init__(
+        self, name: str, kind: str, weight: int, mem_used: float, cpu_max: float
+    ):
+        self.name = name
+        self.kind = kind
+        self.weight = weight
+        self.mem_used = mem_used
+        self.cpu_max = cpu_max